@@ -1,17 +1,21 @@
 import pyparsing as pp
 
+# nested ortholog groups backtrack heavily without memoization
+pp.ParserElement.enablePackrat()
+
 LPAR,RPAR = map(pp.Suppress, "()")
-ortholog = pp.Combine('K' + pp.Word(pp.nums, exact=5))
+ortholog = pp.Regex(r'K\d{5}')
 
 ortholog_group = pp.Forward()
 ortholog_group <<= pp.Group(LPAR + pp.delimitedList(pp.Group(ortholog_group*(1,) & ortholog*(0,))) + RPAR) | pp.delimitedList(ortholog)
 #ortholog_group <<= pp.Group(LPAR + pp.OneOrMore(ortholog_group | pp.delimitedList(ortholog)) + RPAR)
 expr = pp.OneOrMore(ortholog_group)
 
-tests = """\
-        ((K00134,K00150) K00927,K11389) (K00234,K00235)
-        """
-expr.runTests(tests)
+if __name__ == '__main__':
+    tests = """\
+            ((K00134,K00150) K00927,K11389) (K00234,K00235)
+            """
+    expr.runTests(tests)
 
 #steps = OneOrMore(alternating_ortholog | multi_ortholog | ortholog)
 
@@ -1,12 +1,17 @@
 # Copyright 2017 by Connor T. Skennerton. Distributed under the terms of the MIT Lisence
 from __future__ import print_function
 import re
+import sys
 import pickle
+import functools
+import operator
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 
 from Bio.KEGG import _write_kegg, _wrap_kegg
 from Bio.KEGG.REST import kegg_get
 from Bio.KEGG.Compound import Record as KeggCompound, parse as kegg_compound_parse
-from Bio.Pathway import Reaction
 from urllib.error import HTTPError
 
 
@@ -26,6 +31,62 @@ def kegg_compound_read(handle):
         raise ValueError("More than one record found in handle")
     return first
 
+# tokens of a module definition; anything else in the definition is ignored.
+# Only the last space of a run is a token so repeated spaces act as one
+_DEF_TOKEN = re.compile(r'[KM]\d{5}|--|[()+,\-]| (?! )')
+
+# how tightly each operator in a module definition binds. A comma separates
+# alternatives, a space separates consecutive steps and a plus or minus
+# joins the subunits of a complex. A minus with nothing before it marks
+# a single item as optional
+_DEF_PRECEDENCE = {',': 1, ' ': 2, '+': 3, '-': 3, 'optional': 4}
+
+# above this many orthologs bitmasks become long and sparse, and sorted
+# arrays of ortholog ids checked with np.isin are cheaper
+_BITSET_MAX_KOS = 10000
+
+# how many calls to KeggModule.present between reordering its reactions
+_REORDER_INTERVAL = 64
+
+# number of set bits in each possible byte
+_BYTE_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# a line of a KEGG flat file; the keyword is empty on continuation lines
+_KEGG_LINE = re.compile(r'^(\S*)\s*(.*)$')
+
+def gene_mask(gene_list, ko_index):
+    '''Encode a collection of gene identifiers as a bitmask over ko_index
+
+    Genes that are not in ko_index are not part of any enzyme and are ignored
+    '''
+    return functools.reduce(operator.or_, (1 << ko_index[g] for g in gene_list if g in ko_index), 0)
+
+def gene_ids(gene_list, ko_index):
+    '''Encode a collection of gene identifiers as a sorted array of ids in ko_index
+
+    Genes that are not in ko_index are not part of any enzyme and are ignored
+    '''
+    return np.unique(np.fromiter((ko_index[g] for g in gene_list if g in ko_index), dtype=np.int32))
+
+def encode_genes(gene_list, ko_index):
+    '''Encode a collection of gene identifiers to match KeggModule.index
+
+    Returns a bitmask from gene_mask for small ortholog indexes and an
+    array from gene_ids for large ones
+    '''
+    if len(ko_index) > _BITSET_MAX_KOS:
+        return gene_ids(gene_list, ko_index)
+    return gene_mask(gene_list, ko_index)
+
+def pack_masks(masks, n_limbs):
+    '''Split integer bitmasks into 64 bit limbs
+
+    Returns a (len(masks), n_limbs) uint64 array with the least
+    significant limb first
+    '''
+    data = b''.join(m.to_bytes(8 * n_limbs, 'little') for m in masks)
+    return np.frombuffer(data, dtype='<u8').astype(np.uint64).reshape(len(masks), n_limbs)
+
 class KeggParseError(Exception):
     def __init__(self, *args, **kwargs):
         Exception.__init__(self, *args, **kwargs)
@@ -36,13 +97,31 @@ class KeggModule(object):
     def __init__(self):
         self.entry = ""
         self.name = []
-        self.definition = []
         self.orthologs = []
         self.classname = []
         self.pathway = []
         self.reactions = []
         self.compounds = {}
         self.definition = ""
+        self._parsed_steps = None
+        self._present_calls = 0
+        self._reaction_rank = []
+        # (reactions, PackedKeggModule) kept by completeness_matrix
+        self._packed = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_packed', None)
+        return state
+
+    @property
+    def steps(self):
+        '''the steps of the module definition
+
+        The definition is parsed on first use, see
+        _parse_kegg_module_definition for the structure of each step
+        '''
+        return self._parse_kegg_module_definition()
 
     def present(self, gene_list):
         '''Check that all of the reactions can proceed
@@ -50,9 +129,23 @@ class KeggModule(object):
         The will test to make sure that all of the reactions
         have at least one enzyme catalyst that has a gene
         listed in gene_list
+
+        The reactions that have failed most often are checked first so
+        that scanning many genomes stops at a missing reaction as early
+        as possible. The order is refreshed every _REORDER_INTERVAL calls
         '''
-        for r in self.reactions:
+        # the order is kept as positions in self.reactions so that
+        # reactions replaced in place are still the ones that get checked
+        reactions = self.reactions
+        calls = getattr(self, '_present_calls', 0)
+        rank = getattr(self, '_reaction_rank', [])
+        if calls % _REORDER_INTERVAL == 0 or len(rank) != len(reactions):
+            rank = self._reaction_rank = sorted(range(len(reactions)), key=lambda i: -reactions[i]._fail_count)
+        self._present_calls = calls + 1
+        for i in rank:
+            r = reactions[i]
             if not r.present(gene_list):
+                r._fail_count += 1
                 return False
         return True
 
@@ -65,10 +158,113 @@ class KeggModule(object):
 
         return total / len(self.reactions)
 
-    def _parse_kegg_module_definition(self):
-        '''convert a kegg module definition to a series of reactions.
+    def enzymes(self):
+        '''iterate over every enzyme that catalyses a reaction in this module
+        '''
+        for r in self.reactions:
+            for c in r.catalysts:
+                for e in c.enzymes:
+                    yield e
+
+    def ko_index(self):
+        '''give every ortholog used by this module its own bit
+
+        Returns a dict of ortholog accession to bit position suitable
+        for build_masks and gene_mask
+        '''
+        kos = set()
+        for e in self.enzymes():
+            kos.update(sys.intern(str(o)) for o in e.orthologs)
+        return {ko: i for i, ko in enumerate(sorted(kos))}
+
+    def build_masks(self, ko_index):
+        '''encode the orthologs of every enzyme as a bitmask over ko_index
+
+        Once this has been called present and completeness can be given
+        an organism bitmask from gene_mask in place of a set of genes
+        '''
+        for r in self.reactions:
+            for c in r.catalysts:
+                c.finalize(ko_index)
+
+    def index(self, ko_index):
+        '''prepare every enzyme for genes encoded with encode_genes
+
+        Small ortholog indexes use bitmasks (see build_masks) while large,
+        sparse ones use sorted arrays of ortholog ids
+        '''
+        if len(ko_index) > _BITSET_MAX_KOS:
+            for e in self.enzymes():
+                e.build_ids(ko_index)
+        else:
+            self.build_masks(ko_index)
 
-        THIS CURRENTLY DOES NOT WORK PROPERLY
+    def pack(self, n_limbs):
+        '''flatten the enzyme bitmasks into arrays for batch_completeness
+
+        build_masks must have been called first. Returns a tuple of
+        (enzyme_masks, enzyme_popcounts, catalyst_offsets, reaction_offsets).
+        enzyme_masks is a (n_enzymes, n_limbs) uint64 array from pack_masks.
+        The enzymes of catalyst i are those between catalyst_offsets[i] and
+        catalyst_offsets[i + 1] and likewise the catalysts of reaction j
+        are those between reaction_offsets[j] and reaction_offsets[j + 1]
+        '''
+        masks = []
+        popcounts = []
+        catalyst_offsets = [0]
+        reaction_offsets = [0]
+        for r in self.reactions:
+            for c in r.catalysts:
+                for e in c.enzymes:
+                    masks.append(e._bitmask())
+                    popcounts.append(e._popcount)
+                catalyst_offsets.append(len(masks))
+            reaction_offsets.append(len(catalyst_offsets) - 1)
+        return (pack_masks(masks, n_limbs), np.array(popcounts, dtype=np.int64),
+                np.array(catalyst_offsets, dtype=np.int64),
+                np.array(reaction_offsets, dtype=np.int64))
+
+    def freeze(self):
+        '''reduce this module to the arrays needed to evaluate it
+
+        Returns a PackedKeggModule that no longer holds any enzyme or
+        ortholog objects and can be saved in a compact form
+        '''
+        ko_index = self.ko_index()
+        self.build_masks(ko_index)
+        n_limbs = max(1, (len(ko_index) + 63) // 64)
+        return PackedKeggModule(self.entry, self.name, self.definition,
+                [str(r) for r in self.reactions], sorted(ko_index, key=ko_index.get),
+                *self.pack(n_limbs))
+
+    def _packed_is_current(self, reactions):
+        if len(reactions) != len(self.reactions):
+            return False
+        for old, r in zip(reactions, self.reactions):
+            if old is not r:
+                return False
+            for c in r.catalysts:
+                if c._order is None or any(e._mask is None for e in c._order):
+                    return False
+        return True
+
+    def completeness_matrix(self, org_masks):
+        '''return the completeness of every reaction in every organism
+
+        org_masks are organism bitmasks over ko_index(), see
+        PackedKeggModule.completeness_matrix
+
+        The first call freezes the module, which builds the bitmask of
+        every enzyme, and later calls reuse the PackedKeggModule until a
+        reaction, catalyst or enzyme of the module is changed
+        '''
+        cached = getattr(self, '_packed', None)
+        if cached is None or not self._packed_is_current(cached[0]):
+            cached = self._packed = (tuple(self.reactions), self.freeze())
+        return cached[1].completeness_matrix(org_masks)
+
+    def _parse_kegg_module_definition(self):
+        '''convert a kegg module definition to a series of steps.
 
         The M number entry is defined by a logical expression of K numbers
         (and other M numbers), allowing automatic evaluation of whether
@@ -77,56 +273,232 @@ class KeggModule(object):
         comma sign represents an OR operation in this expression. A plus
         sign is used for a molecular complex and a minus sign designates an
         optional item in the complex.
+
+        Returns a list with one entry per step. Each entry is either a
+        K (or M) number or a tuple of (operator, operands) where operator
+        is one of ',', ' ' or '+'. Optional items, whether a subunit after
+        a minus or a minus at the start of a step, are wrapped as
+        ('-', (operand,)). The result is cached along with the definition it
+        came from, so the definition is only parsed again when it changes.
+        A KeggParseError is raised if the definition is malformed.
         '''
-        bracket = 0
-        current_KO = ''
-        current_enzyme = []
-        step_definition = ''
-        steps = []
-        step_enzymes = []
-        current_enzyme = []
-        for c in self.definition:
-            if c == '(':
-                bracket += 1
-            elif c == ' ':
-                current_enzyme.append(current_KO)
-                current_KO = ''
-                if bracket == 0:
-                    # we have reached the end of this step
-
-                    #step_definition = ''
-                    step_enzymes.append(current_enzyme)
-                    current_enzyme = []
-                    steps.append(step_enzymes)
-                    step_enzymes = []
-                    continue
+        # pickles from before the definition was kept hold only the steps
+        cached = getattr(self, '_parsed_steps', None)
+        if isinstance(cached, tuple) and cached[0] == self.definition:
+            return cached[1]
+        definition = self.definition
+
+        operands = []
+        operators = []
+        # nodes that were closed off by a bracket must not be merged
+        # into an enclosing expression with the same operator. They are
+        # kept referenced here so that their ids cannot be reused
+        grouped = {}
+        # whether the next token has to begin an operand. A minus there
+        # marks the following operand as optional
+        expect_operand = True
+        # a space only joins steps if an operand follows it, so it is
+        # held back until the next token is seen
+        pending_space = False
+
+        def error():
+            raise KeggParseError("The module definition:\n{}\ncould not be parsed properly".format(definition))
+
+        def reduce():
+            op = operators.pop()
+            if op == 'optional':
+                operands.append(('-', (operands.pop(),)))
+                return
+            right = operands.pop()
+            left = operands.pop()
+            if op == '-':
+                op, right = '+', ('-', (right,))
+            items = []
+            for node in (left, right):
+                if isinstance(node, tuple) and node[0] == op and id(node) not in grouped:
+                    items.extend(node[1])
                 else:
-                    # we are still internal to this step
-                    pass
-            elif c == ')':
-                bracket -= 1
-            elif c == '+':
-                # we have a complex (multiple subunits)
-                current_enzyme.append(current_KO)
-                current_KO = ''
-
-            elif c == '-':
-                # we have an optional subunit comming up
-                current_enzyme.append(current_KO)
-                current_KO = ''
-            elif c == ',':
-                # this is an alternation for this step
-                # this should be the end of this enzyme
-                current_enzyme.append(current_KO)
-                step_enzymes.append(current_enzyme)
-                current_enzyme = []
-                current_KO = ''
-            elif c in ['K', '0', '1', '2', '3', '4', '5', '6', '7', '8', '9']:
-                # this char is part of a KO number
-                current_KO += c
-
-            #step_definition += c
-        #print(steps)
+                    items.append(node)
+            operands.append((op, tuple(items)))
+
+        def _binary(tok):
+            nonlocal expect_operand, pending_space
+            pending_space = False
+            if expect_operand:
+                error()
+            while operators and operators[-1] != '(' and \
+                    _DEF_PRECEDENCE[operators[-1]] >= _DEF_PRECEDENCE[tok]:
+                reduce()
+            operators.append(tok)
+            expect_operand = True
+
+        def _start_operand():
+            if pending_space:
+                _binary(' ')
+            if not expect_operand:
+                error()
+
+        def _operand(tok):
+            nonlocal expect_operand
+            _start_operand()
+            # it's a KO. The same KOs recur across modules and gene
+            # lists so share a single string for each
+            operands.append(sys.intern(tok))
+            expect_operand = False
+
+        def _open(tok):
+            _start_operand()
+            operators.append(tok)
+
+        def _close(tok):
+            nonlocal expect_operand, pending_space
+            pending_space = False
+            if expect_operand:
+                error()
+            while operators and operators[-1] != '(':
+                reduce()
+            if not operators:
+                error()
+            operators.pop()
+            grouped[id(operands[-1])] = operands[-1]
+
+        def _space(tok):
+            nonlocal pending_space
+            if not expect_operand:
+                pending_space = True
+
+        def _minus(tok):
+            if expect_operand or pending_space:
+                # an optional item at the start of a step or group
+                _start_operand()
+                operators.append('optional')
+            else:
+                _binary(tok)
+
+        handlers = {'(': _open, ')': _close, ' ': _space, '+': _binary,
+                ',': _binary, '-': _minus}
+        for tok in _DEF_TOKEN.findall(definition):
+            handlers.get(tok, _operand)(tok)
+        if expect_operand and (operands or operators):
+            error()
+        while operators:
+            if operators[-1] == '(':
+                error()
+            reduce()
+
+        if not operands:
+            steps = []
+        elif isinstance(operands[0], tuple) and operands[0][0] == ' ' and id(operands[0]) not in grouped:
+            steps = list(operands[0][1])
+        else:
+            steps = [operands[0]]
+        self._parsed_steps = (definition, steps)
+        return steps
+
+class PackedKeggModule(object):
+    '''A KeggModule reduced to bitmask arrays
+
+    The orthologs of each enzyme are stored as a bitmask over kos, laid
+    out as described in KeggModule.pack. The reactions are only kept as
+    their string representation.
+    '''
+    def __init__(self, entry, name, definition, reactions, kos, enzyme_masks,
+            enzyme_popcounts, catalyst_offsets, reaction_offsets):
+        self.entry = entry
+        self.name = name
+        self.definition = definition
+        self.reactions = reactions
+        self.kos = kos
+        self.enzyme_masks = enzyme_masks
+        self.enzyme_popcounts = enzyme_popcounts
+        self.catalyst_offsets = catalyst_offsets
+        self.reaction_offsets = reaction_offsets
+
+    def ko_index(self):
+        '''return the bit position of each ortholog
+        '''
+        return {ko: i for i, ko in enumerate(self.kos)}
+
+    def completeness_matrix(self, org_masks):
+        '''return the completeness of every reaction in every organism
+
+        org_masks is either a sequence of organism bitmasks over
+        ko_index() from gene_mask or a (n_organisms, n_limbs) array from
+        pack_masks. Returns a (n_reactions, n_organisms) float64 array.
+        The numba kernel is used when it is installed, otherwise the
+        matrix is computed with numpy broadcasting
+        '''
+        from kegg_numba import batch_completeness, _NUMBA_AVAILABLE
+        if not isinstance(org_masks, np.ndarray):
+            org_masks = pack_masks(org_masks, self.enzyme_masks.shape[1])
+        org_masks = np.ascontiguousarray(org_masks, dtype=np.uint64)
+        if not _NUMBA_AVAILABLE:
+            return _completeness_matrix(self.enzyme_masks, self.enzyme_popcounts,
+                    self.catalyst_offsets, self.reaction_offsets, org_masks)
+        out = np.zeros((len(self.reaction_offsets) - 1, len(org_masks)))
+        batch_completeness(self.enzyme_masks, self.enzyme_popcounts,
+                self.catalyst_offsets, self.reaction_offsets, org_masks, out)
+        return out
+
+    def save(self, handle):
+        '''write the module to handle as a compressed numpy archive
+        '''
+        np.savez_compressed(handle, entry=np.array(self.entry),
+                name=np.array(self.name, dtype=str),
+                definition=np.array(self.definition),
+                reactions=np.array(self.reactions, dtype=str),
+                kos=np.array(self.kos, dtype=str),
+                enzyme_masks=self.enzyme_masks,
+                enzyme_popcounts=self.enzyme_popcounts,
+                catalyst_offsets=self.catalyst_offsets,
+                reaction_offsets=self.reaction_offsets)
+
+
+def _completeness_matrix(enzyme_masks, enzyme_popcounts, catalyst_offsets, reaction_offsets, org_masks):
+    '''numpy equivalent of kegg_numba.batch_completeness that returns the matrix
+    '''
+    # fraction of each enzyme's orthologs found in each organism
+    shared = enzyme_masks[:, None, :] & org_masks[None, :, :]
+    shared = _BYTE_POPCOUNT[shared.view(np.uint8)].sum(axis=2, dtype=np.int64)
+    fractions = np.zeros((len(enzyme_masks) + 1, len(org_masks)))
+    np.divide(shared, enzyme_popcounts[:, None], out=fractions[:-1],
+            where=enzyme_popcounts[:, None] != 0)
+
+    # lay the enzymes of each reaction out in a padded matrix, where the
+    # padding points at the empty last row of fractions, and take the
+    # best enzyme of each reaction
+    first = catalyst_offsets[reaction_offsets[:-1]]
+    last = catalyst_offsets[reaction_offsets[1:]]
+    width = max(1, int((last - first).max(initial=0)))
+    enzymes = first[:, None] + np.arange(width)[None, :]
+    enzymes = np.where(enzymes < last[:, None], enzymes, len(enzyme_masks))
+    return fractions[enzymes].max(axis=1)
+
+def load_packed(handle):
+    '''read a PackedKeggModule written by PackedKeggModule.save
+    '''
+    with np.load(handle, allow_pickle=False) as data:
+        return PackedKeggModule(data['entry'].item(), data['name'].tolist(),
+                data['definition'].item(), data['reactions'].tolist(),
+                [sys.intern(ko) for ko in data['kos'].tolist()], data['enzyme_masks'],
+                data['enzyme_popcounts'], data['catalyst_offsets'],
+                data['reaction_offsets'])
+
+def _set_slots(obj, state):
+    '''restore an object with __slots__ from a pickle
+
+    Pickles written before the class used __slots__ hold a plain
+    __dict__ rather than a (dict, slots) pair. Attributes missing from
+    older pickles keep their default from __init__ and ones that are no
+    longer slots are dropped
+    '''
+    obj.__init__()
+    if isinstance(state, tuple):
+        dict_state, slot_state = state
+        state = dict(dict_state or {}, **(slot_state or {}))
+    for key, value in state.items():
+        if key in obj.__slots__:
+            setattr(obj, key, value)
 
 class KeggOrtholog(object):
     '''Representation of a kegg ortholog
@@ -153,6 +525,7 @@ class KeggEnzyme(object):
     This is a container class for holding multiple KEGG orthologs
     that each act as a subunit in the enzyme.
     '''
+    __slots__ = ('entry', 'orthologs', '_mask', '_popcount', '_ids', '_h')
 
     def __init__(self, accession=None):
         '''Initialize the object
@@ -160,11 +533,29 @@ class KeggEnzyme(object):
         Arguments:
             - accession: the EC number for the enzyme. eg. 1.1.1.1
         '''
-        self.entry = accession
+        self.entry = sys.intern(accession) if accession is not None else None
         self.orthologs = set()
+        self._mask = None
+        self._popcount = 0
+        self._ids = None
+        self._h = None
+
+    # string hashes are salted per process, so a hash cached by the
+    # process that wrote a pickle is meaningless in the one reading it
+    def __getstate__(self):
+        return (None, {k: getattr(self, k) for k in self.__slots__ if k != '_h' and hasattr(self, k)})
+
+    def __setstate__(self, state):
+        _set_slots(self, state)
+        self._h = None
 
     def __hash__(self):
-        return hash(self.entry) + hash(''.join(self.orthologs))
+        # orthologs may be KeggOrtholog objects or accession strings,
+        # both of which convert to the accession. The hash is cached
+        # until the orthologs change
+        if self._h is None:
+            self._h = hash((self.entry, frozenset(str(o) for o in self.orthologs)))
+        return self._h
 
     def __eq__(self, other):
         return self.entry == other.entry and self.orthologs == other.orthologs
@@ -182,24 +573,79 @@ class KeggEnzyme(object):
         #if not isinstance(KeggOrtholog, ortholog):
         #    raise RuntimeError("You must provide a KeggOrtholog object to KeggEnzyme")
         self.orthologs.add(ortholog)
+        self._changed()
 
     def remove(self, ortholog):
         self.orthologs.remove(ortholog)
+        self._changed()
+
+    def _changed(self):
+        # the cached hash and encodings no longer match the orthologs
+        self._h = None
+        self._mask = None
+        self._popcount = 0
+        self._ids = None
+
+    def _bitmask(self):
+        if self._mask is None:
+            raise ValueError("KeggEnzyme.build_mask must be called before checking an organism bitmask")
+        return self._mask
+
+    def _id_array(self):
+        if self._ids is None:
+            raise ValueError("KeggEnzyme.build_ids must be called before checking an array of gene ids")
+        return self._ids
+
+    def build_mask(self, ko_index):
+        '''Encode the orthologs as a bitmask over ko_index
+
+        Arguments:
+            - ko_index: a dict mapping each ortholog accession to a bit
+        '''
+        self._mask = 0
+        for o in self.orthologs:
+            self._mask |= 1 << ko_index[str(o)]
+        self._popcount = self._mask.bit_count()
+
+    def build_ids(self, ko_index):
+        '''Encode the orthologs as a sorted array of their ids in ko_index
+        '''
+        self._ids = np.sort(np.fromiter((ko_index[str(o)] for o in self.orthologs),
+                dtype=np.int32, count=len(self.orthologs)))
 
     def present(self, gene_list):
         '''Check if the gene_list contains all of the orthologs for this enzyme
+
+        gene_list can either be a set of gene identifiers, an integer
+        bitmask from gene_mask or an array from gene_ids, in which case
+        build_mask or build_ids must have been called first
         '''
+        if isinstance(gene_list, int):
+            mask = self._bitmask()
+            return mask != 0 and (mask & ~gene_list) == 0
+        if isinstance(gene_list, np.ndarray):
+            ids = self._id_array()
+            return len(ids) != 0 and bool(np.isin(ids, gene_list, assume_unique=True).all())
         if len(self.orthologs) == 0:
             return False
         return self.orthologs.issubset(gene_list)
 
     def completeness(self, gene_list):
+        if isinstance(gene_list, int):
+            mask = self._bitmask()
+            if self._popcount == 0:
+                return 0.0
+            return (mask & gene_list).bit_count() / self._popcount
+        if isinstance(gene_list, np.ndarray):
+            ids = self._id_array()
+            if len(ids) == 0:
+                return 0.0
+            return int(np.isin(ids, gene_list, assume_unique=True).sum()) / len(ids)
         orthos = len(self.orthologs)
         if orthos == 0:
             return 0.0
-        p = self.orthologs - gene_list
-        diff = len(self.orthologs - gene_list)
-        return (orthos - diff) / orthos
+        missing = sum(1 for o in self.orthologs if o not in gene_list)
+        return (orthos - missing) / orthos
 
 
 class Catalyst(object):
@@ -210,9 +656,14 @@ class Catalyst(object):
     organism can perform a certain reaction we want to know whether
     all of the subunits are present in at least one of the enzymes
     '''
+    __slots__ = ('enzymes', '_order')
 
     def __init__(self):
         self.enzymes = set()
+        # enzymes largest first, set by finalize
+        self._order = None
+
+    __setstate__ = _set_slots
 
     def add(self, enzyme):
         '''add a KeggEnzyme object to the catalyst
@@ -222,6 +673,7 @@ class Catalyst(object):
                 self.enzymes.add(e)
         else:
             self.enzymes.add(enzyme)
+        self._order = None
 
     def __repr__(self):
         orthologs = 0
@@ -237,17 +689,42 @@ class Catalyst(object):
             info.append(str(i))
         return '\n'.join(info)
 
+    def finalize(self, ko_index):
+        '''build the bitmask of every enzyme over ko_index
+
+        The enzymes are kept with the largest first, which present and
+        completeness use when given an organism bitmask. Their masks are
+        read from the enzymes on each call, so editing an enzyme afterwards
+        needs another finalize
+        '''
+        for e in self.enzymes:
+            e.build_mask(ko_index)
+        self._order = tuple(sorted(self.enzymes, key=lambda e: -e._popcount))
+
+    def _enzyme_masks(self):
+        if self._order is None:
+            raise ValueError("Catalyst.finalize must be called before checking an organism bitmask")
+        for e in self._order:
+            yield e._bitmask(), e._popcount
+
     def present(self, gene_list):
         '''Given a list of gene identifiers this method will check to see
         if any of the catalysts given have all of their required
         subunits present in the list
+
+        gene_list can also be an integer bitmask from gene_mask, in which
+        case finalize must have been called first
         '''
+        if isinstance(gene_list, int):
+            return any(m != 0 and (m & ~gene_list) == 0 for m, _ in self._enzyme_masks())
         for i in self.enzymes:
             if i.present(gene_list):
                 return True
         return False
 
     def completeness(self, gene_list):
+        if isinstance(gene_list, int):
+            return max(((m & gene_list).bit_count() / p for m, p in self._enzyme_masks() if p), default=0.0)
         max_comp = 0.0
         for i in self.enzymes:
             m = i.completeness(gene_list)
@@ -256,13 +733,64 @@ class Catalyst(object):
         return max_comp
 
 
-class KeggReaction(Reaction):
+class KeggReaction(object):
     '''Representation of a kegg reaction
+
+    This has the same attributes as Bio.Pathway.Reaction:
+     - reactants: dict of compound to its stoichiometric coefficient,
+       which is negative for substrates and positive for products
+     - catalysts: tuple of Catalyst objects for this reaction
+     - reversible: true if the reaction is reversible
+     - data: the reaction accessions from the module definition
     '''
+    __slots__ = ('reactants', 'catalysts', 'reversible', 'data', '_fail_count')
+
     def __init__(self,reactants=None, catalysts=(),
                              reversible=0, data=None):
-        super(KeggReaction, self).__init__(reactants=reactants, catalysts=catalysts,
-                                 reversible=reversible, data=data)
+        if reactants is None:
+            self.reactants = {}
+        else:
+            self.reactants = {r: v for r, v in reactants.items() if v != 0}
+        self.catalysts = tuple(catalysts)
+        self.reversible = reversible
+        self.data = data
+        # how many times this reaction was why KeggModule.present failed
+        self._fail_count = 0
+
+    __setstate__ = _set_slots
+
+    def __eq__(self, other):
+        return (isinstance(other, KeggReaction) and self.reactants == other.reactants
+                and self.catalysts == other.catalysts and self.data == other.data
+                and self.reversible == other.reversible)
+
+    def __hash__(self):
+        return hash(tuple(self.species()))
+
+    def __repr__(self):
+        return 'KeggReaction({!r}, {!r}, {!r}, {!r})'.format(self.reactants,
+                self.catalysts, self.reversible, self.data)
+
+    def __str__(self):
+        substrates = []
+        products = []
+        for species in sorted(self.reactants):
+            stoch = self.reactants[species]
+            if abs(stoch) == 1:
+                term = str(species)
+            else:
+                term = '{} {}'.format(abs(stoch), species)
+            if stoch < 0:
+                substrates.append(term)
+            else:
+                products.append(term)
+        arrow = ' <=> ' if self.reversible else ' --> '
+        return ' + '.join(substrates) + arrow + ' + '.join(products)
+
+    def species(self):
+        '''return a list of all the compounds in the reaction
+        '''
+        return list(self.reactants)
 
     def present(self, gene_list):
         '''Check if this reaction can be performed using the specified genes.
@@ -291,12 +819,36 @@ class KeggReaction(Reaction):
         return max_gene
 
 
+# number of concurrent requests made to the KEGG REST server
+_KEGG_WORKERS = 8
+
+@functools.lru_cache(maxsize=4096)
+def _kegg_get_cached(accession):
+    '''fetch a KEGG entry, remembering its text for later calls
+    '''
+    return kegg_get(accession).read()
+
+def _kegg_fetch_all(accessions, executor):
+    '''fetch several KEGG entries concurrently on executor
+
+    Returns a dict with the text of each entry, or the HTTPError that
+    was raised while fetching it
+    '''
+    def fetch(accession):
+        try:
+            return _kegg_get_cached(accession)
+        except HTTPError as error:
+            return error
+
+    accessions = list(dict.fromkeys(accessions))
+    return dict(zip(accessions, executor.map(fetch, accessions)))
+
 def parse_enzyme_file(handle, enzyme):
     record = enzyme
     state = ''
     def parse_orthology(line, record):
         accession, _ = line.split(None, 1)
-        record.add(accession)
+        record.add(sys.intern(accession))
     for line in handle:
         if line[:3] == '///':
             return
@@ -310,26 +862,37 @@ def parse_enzyme_file(handle, enzyme):
                 parse_orthology(line, record)
 
 
-def parse_reaction_file(handle):
-    state = ''
+def _reaction_enzyme_lines(handle):
+    lines = []
+    for line in handle:
+        if line[:3] == '///':
+            break
+        elif line[:6] == 'ENZYME':
+            lines.append(line[6:])
+    return lines
+
+def _enzyme_accessions(lines):
+    return [e for line in lines for e in line.strip().split()]
+
+def _build_enzymes(lines, entries):
     ret = []
-    def parse_enzyme(line):
+    for line in lines:
         enzymes = line.strip().split()
         for e in enzymes:
-            enzyme = KeggEnzyme(e)
-            try:
-                parse_enzyme_file(kegg_get(e), enzyme)
-            except HTTPError as error:
+            if isinstance(entries[e], HTTPError):
                 print("cannot get information for enzyme: {}\nsource line:\n{}\nenzyme list:\n{}".format(e, line, str(enzymes)))
             else:
+                enzyme = KeggEnzyme(e)
+                parse_enzyme_file(entries[e].splitlines(True), enzyme)
                 ret.append(enzyme)
+    return ret
 
-    for line in handle:
-        if line[:3] == '///':
-            return ret
-        elif line[:6] == 'ENZYME':
-            state = 'ENZYME'
-            parse_enzyme(line[6:])
+def parse_reaction_file(handle):
+    lines = _reaction_enzyme_lines(handle)
+    # fetch every enzyme up front so that the requests run concurrently
+    with ThreadPoolExecutor(max_workers=_KEGG_WORKERS) as executor:
+        entries = _kegg_fetch_all(_enzyme_accessions(lines), executor)
+    return _build_enzymes(lines, entries)
 
 def parse(handle):
     def parse_orthology(string, record):
@@ -374,22 +937,37 @@ def parse(handle):
             #        print(substrate)
             #        raise e
             #    record.compounds[substrate] = sub
-            reactants[substrate] = -1
+            reactants[sys.intern(substrate)] = -1
         for product in products:
             #if product not in record.compounds:
             #    prod = kegg_compound_read(kegg_get(product))
             #    record.compounds[product] = prod
-            reactants[product] = 1
+            reactants[sys.intern(product)] = 1
 
-        catalyst = Catalyst()
-        for rxn in rxns.split(','):
-            enzymes = []
-            for r in rxn.split('+'):
-                enzymes.extend(parse_reaction_file(kegg_get(rxn)))
-            catalyst.add(enzymes)
+        # the entries are fetched for the whole record at once in
+        # fetch_reactions
+        pending.append((reactants, rxns))
 
-        #print(catalyst)
-        record.reactions.append( KeggReaction(reactants, catalysts=(catalyst,), reversible=1, data = rxns))
+    def fetch_reactions(record):
+        accessions = [r for _, rxns in pending for rxn in rxns.split(',') for r in rxn.split('+')]
+        with ThreadPoolExecutor(max_workers=_KEGG_WORKERS) as executor:
+            reactions = _kegg_fetch_all(accessions, executor)
+            enzyme_lines = {r: _reaction_enzyme_lines(entry.splitlines(True))
+                    for r, entry in reactions.items() if not isinstance(entry, HTTPError)}
+            accessions = [e for lines in enzyme_lines.values() for e in _enzyme_accessions(lines)]
+            entries = _kegg_fetch_all(accessions, executor)
+
+        for reactants, rxns in pending:
+            catalyst = Catalyst()
+            for rxn in rxns.split(','):
+                enzymes = []
+                for r in rxn.split('+'):
+                    if isinstance(reactions[r], HTTPError):
+                        raise reactions[r]
+                    enzymes.extend(_build_enzymes(enzyme_lines[r], entries))
+                catalyst.add(enzymes)
+            record.reactions.append( KeggReaction(reactants, catalysts=(catalyst,), reversible=1, data = rxns))
+        del pending[:]
 
     def parse_compound(string, record):
         accession, name = string.strip().split(None, 2)
@@ -397,44 +975,62 @@ def parse(handle):
         comp.name.append(name)
         self.compounds.append(comp)
 
+    def parse_entry(string, record):
+        try:
+            accession, entry_class = string.split(None, 1)
+        except ValueError as e:
+            print(string)
+            raise e
+        record.entry = accession
+
+    def parse_name(string, record):
+        record.name.append(string.strip())
+
+    def parse_definition(string, record):
+        record.definition = string.strip()
+
+    def parse_class(string, record):
+        record.classname.append(string.strip())
+
+    handlers = {'ENTRY': parse_entry, 'NAME': parse_name,
+            'DEFINITION': parse_definition, 'ORTHOLOGY': parse_orthology,
+            'CLASS': parse_class, 'PATHWAY': parse_pathway,
+            'REACTION': parse_reaction}
+    # fields whose entries continue onto the following indented lines.
+    # COMPOUND should already be taken care of in the reactions
+    continuations = {'ORTHOLOGY': parse_orthology, 'PATHWAY': parse_pathway,
+            'REACTION': parse_reaction}
+
     state = ''
     record = KeggModule()
+    # (reactants, reaction accessions) of each REACTION line in the record
+    pending = []
     for line in handle:
-        if line[:3] == '///':
+        keyword, body = _KEGG_LINE.match(line).groups()
+        if keyword == '///':
+            fetch_reactions(record)
             yield record
             record = KeggModule()
-        elif line[:5] == 'ENTRY':
-            try:
-                pathway, accession, entry_class = line.strip().split(None, 2)
-            except ValueError as e:
-                print(line)
-                raise e
-            record.entry = accession
-        elif line[:4] == 'NAME':
-            record.name.append(line[4:].strip())
-        elif line[:10] == 'DEFINITION':
-            record.definition = line[10:].strip()
-        elif line[:9] == 'ORTHOLOGY':
-            state = 'ORTHOLOGY'
-            parse_orthology(line[9:], record)
-        elif line[:5] == 'CLASS':
-            record.classname.append(line[5:].strip())
-        elif line[:7] == 'PATHWAY':
-            state = 'PATHWAY'
-            parse_pathway(line[7:], record)
-        elif line[:8] == 'REACTION':
-            state = 'REACTION'
-            parse_reaction(line[8:], record)
-        elif line[:8] == 'COMPOUND':
-            state = 'COMPOUND'
-            # this should already be taken care of in the reactions
-            #parse_compound(line[8:], record)
-
-        elif line[0] == ' ':
-            if state == 'ORTHOLOGY':
-                parse_orthology(line, record)
-            elif state == 'PATHWAY':
-                parse_pathway(line, record)
-            elif state == 'REACTION':
-                parse_reaction(line, record)
+        elif keyword:
+            state = keyword
+            handler = handlers.get(keyword)
+            if handler is not None:
+                handler(body, record)
+        elif body:
+            handler = continuations.get(state)
+            if handler is not None:
+                handler(body, record)
 
+if __name__ == '__main__':
+    tests = (
+        ('M00001', '(K00844,K12407,K00845,K25026,K00886,K08074,K00918) (K01810,K06859,K13810,K15916) (K00850,K16370,K21071,K00918) (K01623,K01624,K11645,K16305,K16306) K01803 ((K00134,K00150) K00927,K11389) (K01834,K15633,K15634,K15635) K01689 (K00873,K12406)'),
+        ('M00009', '(K01647,K05942,K01659) (K01681,K01682) (K00031,K00030) ((K00164+K00658,K01616)+K00382,K00174+K00175-K00177-K00176) (K01902+K01903,K01899+K01900,K18118) (K00234+K00235+K00236+(K00237,K25801),K00239+K00240+K00241-(K00242,K18859,K18860),K00244+K00245+K00246-K00247) (K01676,K01679,K01677+K01678) (K00026,K00025,K00024,K00116)'),
+        ('M00014', 'K00012 (K12447,K16190) (K00699,K01195,K14756) (K00002,K13247) -K03331 (K05351,K00008) K00854'),
+        )
+    for accession, definition in tests:
+        module = KeggModule()
+        module.entry = accession
+        module.definition = definition
+        print(accession, definition, sep='\n')
+        for step in module.steps:
+            print('   ', step)
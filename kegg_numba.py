@@ -0,0 +1,65 @@
+# Copyright 2017 by Connor T. Skennerton. Distributed under the terms of the MIT Lisence
+'''Batch evaluation of reaction completeness for many organisms at once
+
+The kernel is compiled with numba when it is installed and otherwise
+runs as ordinary python.
+'''
+import numpy as np
+
+try:
+    from numba import njit, prange
+    _NUMBA_AVAILABLE = True
+except ImportError:
+    _NUMBA_AVAILABLE = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        def decorator(func):
+            return func
+        return decorator
+
+
+if _NUMBA_AVAILABLE:
+    @njit(cache=True)
+    def _popcount(x):
+        # count the set bits of a uint64 a byte at a time
+        x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+        x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+        x = (x + (x >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+        return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+else:
+    def _popcount(x):
+        return int(x).bit_count()
+
+
+@njit(parallel=True, cache=True)
+def batch_completeness(enzyme_masks, enzyme_popcounts, catalyst_offsets, reaction_offsets, org_masks, out):
+    '''Fill out with the completeness of each reaction in each organism
+
+    Arguments:
+        - enzyme_masks, enzyme_popcounts, catalyst_offsets, reaction_offsets:
+          a module flattened by KeggModule.pack
+        - org_masks: a (n_organisms, n_limbs) uint64 array of organism
+          bitmasks from pack_masks
+        - out: a (n_reactions, n_organisms) float64 array
+
+    The completeness of a reaction is the largest fraction of orthologs
+    present for any enzyme of any of its catalysts, as in
+    KeggReaction.completeness
+    '''
+    n_reactions = reaction_offsets.shape[0] - 1
+    n_limbs = enzyme_masks.shape[1]
+    for o in prange(org_masks.shape[0]):
+        for r in range(n_reactions):
+            best = 0.0
+            for c in range(reaction_offsets[r], reaction_offsets[r + 1]):
+                for e in range(catalyst_offsets[c], catalyst_offsets[c + 1]):
+                    if enzyme_popcounts[e] == 0:
+                        continue
+                    shared = 0
+                    for l in range(n_limbs):
+                        shared += _popcount(enzyme_masks[e, l] & org_masks[o, l])
+                    comp = shared / enzyme_popcounts[e]
+                    if comp > best:
+                        best = comp
+            out[r, o] = best
@@ -8,9 +8,13 @@ if __name__ == '__main__':
     from kegg_module import KeggModule, KeggReaction, Catalyst, KeggEnzyme, parse
     parser = argparse.ArgumentParser()
     parser.add_argument("pathway", help="An accession to a kegg module")
-    parser.add_argument("outfile", help="output file for the pickled KeggModule object")
+    parser.add_argument("outfile", help="output file for the pickled KeggModule object. If it ends in .npz only the bitmasks needed by pathway_presence.py are saved")
     args = parser.parse_args()
 
     for module in parse(kegg_get(args.pathway)):
-        with open(args.outfile, 'wb') as pickled:
-            pickle.dump(file=pickled, obj=module, protocol=-1)
+        if args.outfile.endswith('.npz'):
+            with open(args.outfile, 'wb') as packed:
+                module.freeze().save(packed)
+        else:
+            with open(args.outfile, 'wb') as pickled:
+                pickle.dump(file=pickled, obj=module, protocol=-1)
@@ -1,9 +1,79 @@
 #!/usr/bin/env python
 import argparse
 import pickle
-import pandas as pd
-from plotnine import *
+import sys
+import numpy as np
 import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from kegg_module import gene_mask, pack_masks, load_packed
+
+# the gene list of each worker process, set once by _init_worker
+_gene_list = None
+
+
+def _plot(rows, reaction_steps, outname):
+    '''Save a heatmap of the completeness of each reaction in each organism
+    '''
+    # plotnine and pandas are slow to import so only do it when plotting
+    import pandas as pd
+    from plotnine import ggplot, aes, geom_tile, scale_x_discrete, theme_minimal, theme, element_text
+    data = pd.DataFrame.from_records(rows, columns=['organism', 'reaction', 'completeness'])
+    p = (ggplot(data, aes('reaction', 'organism', fill='completeness')) + geom_tile() + scale_x_discrete(limits=reaction_steps) + theme_minimal() + theme(axis_text_x=element_text(rotation=45, hjust=1)))
+    p.save(outname)
+
+
+def process_pathway(pathway, gene_list, plot=True):
+    '''Plot the completeness of each reaction in a saved KeggModule
+
+    pathway is either a pickled KeggModule or a PackedKeggModule saved
+    as a .npz file. Every reaction is evaluated against each organism in
+    gene_list and the result is saved as a heatmap named after the
+    pathway file, or as a tab separated table if plot is False. Returns
+    the name of the file that was written.
+    '''
+    if pathway.endswith('.npz'):
+        with open(pathway, 'rb') as packed:
+            kegg_module = load_packed(packed)
+    else:
+        with open(pathway, 'rb') as pickled:
+            kegg_module = pickle.load(pickled).freeze()
+
+    # every ortholog in the module has its own bit so that each enzyme
+    # and organism can be represented as a bitmask
+    ko_index = kegg_module.ko_index()
+    n_limbs = kegg_module.enzyme_masks.shape[1]
+    organisms = list(gene_list)
+    org_masks = pack_masks([gene_mask(gene_list[o], ko_index) for o in organisms], n_limbs)
+
+    # organisms that share the same orthologs share the same mask,
+    # so only evaluate each distinct mask once
+    org_masks, inverse = np.unique(org_masks, axis=0, return_inverse=True)
+    comp = kegg_module.completeness_matrix(org_masks)[:, inverse.ravel()]
+
+    rows = []
+    for reaction, completeness in zip(kegg_module.reactions, comp.tolist()):
+        for organism, c in zip(organisms, completeness):
+            rows.append((organism, reaction, c))
+    if plot:
+        outname = "{}.pdf".format(os.path.basename(pathway))
+        _plot(rows, kegg_module.reactions, outname)
+    else:
+        outname = "{}.tsv".format(os.path.basename(pathway))
+        with open(outname, 'w') as fp:
+            print('organism', 'reaction', 'completeness', sep="\t", file=fp)
+            for row in rows:
+                print(*row, sep="\t", file=fp)
+    return outname
+
+
+def _init_worker(gene_list):
+    global _gene_list
+    _gene_list = gene_list
+
+
+def _process_pathway_worker(pathway, plot):
+    return process_pathway(pathway, _gene_list, plot)
 
 
 if __name__ == '__main__':
@@ -11,7 +81,9 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-2', '--2', dest='two_column', action='store_true', default=False, help='input is a two column file, the first column is the organism name and the second column is the gene identifier')
     parser.add_argument("gene_list", help="A file containing gene identifiers, one per line")
-    parser.add_argument("pathway", nargs='+', help="A pickled KeggModule object")
+    parser.add_argument('--no-plot', dest='plot', action='store_false', default=True, help='write the completeness of each reaction to a tab separated file instead of plotting it')
+    parser.add_argument('-p', '--processes', type=int, default=None, help='number of pathways to process at once. Defaults to the number of CPUs')
+    parser.add_argument("pathway", nargs='+', help="A pickled KeggModule object or a packed module ending in .npz")
     args = parser.parse_args()
     gene_list = {}
     with open(args.gene_list) as fp:
@@ -21,29 +93,21 @@ if __name__ == '__main__':
                     organism, gene = line.strip().split('\t')
                 except ValueError as e:
                     raise ValueError("problem on line {}\n{}".format(n, e))
+                gene = sys.intern(gene)
                 try:
                     gene_list[organism].add(gene)
                 except KeyError:
                     gene_list[organism] = set([gene])
             else:
-                gene = line.strip()
+                gene = sys.intern(line.strip())
                 try:
                     gene_list[''].add(gene)
                 except KeyError:
                     gene_list[''] = set([gene])
 
-    for pathway in args.pathway:
-        data = {'organism': [], 'reaction': [], 'completeness': []}
-        reaction_steps = []
-        with open(pathway, 'rb') as pickled:
-            kegg_module = pickle.load(pickled)
-            for reaction in kegg_module.reactions:
-                reaction_steps.append(str(reaction))
-                for organism, genes in gene_list.items():
-                    data['organism'].append(organism)
-                    data['reaction'].append(str(reaction))
-                    data['completeness'].append(reaction.completeness(genes))
-                    #print(organism, reaction, reaction.completeness(genes), sep="\t")
-        data = pd.DataFrame(data)
-        p = (ggplot(data, aes('reaction', 'organism', fill='completeness')) + geom_tile() + scale_x_discrete(limits=reaction_steps) + theme_minimal() + theme(axis_text_x=element_text(rotation=45, hjust=1)))
-        p.save("{}.pdf".format(os.path.basename(pathway)))
+    # each pathway is independent so they can be evaluated and plotted
+    # in separate processes. The gene list is sent to each worker once
+    # rather than with every pathway. The results are consumed so that
+    # any error in a worker is raised here
+    with ProcessPoolExecutor(max_workers=args.processes, initializer=_init_worker, initargs=(gene_list,)) as executor:
+        list(executor.map(_process_pathway_worker, args.pathway, repeat(args.plot)))